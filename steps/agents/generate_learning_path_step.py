@@ -1,39 +1,203 @@
 """
-Python LangGraph Agent for Learning Path Generation
+Python Agent for Learning Path Generation
 Subscribes to 'learning.path.requested' event from TypeScript API
-Uses LangGraph + Gemini to orchestrate AI-powered curriculum generation with streaming
+Runs a linear async pipeline over Groq and streams progress updates to the client
 """
 
 import os
-import json
-from typing import Any, Dict, List, Optional
+import time
+import importlib.util
+import asyncio
+import random
+import hashlib
+from dataclasses import dataclass, field
+from typing import Any, Callable, Dict, List, Optional
 from datetime import datetime
 
-# LangGraph imports
-from langgraph.graph import StateGraph, END
+import httpx
+import orjson
+
 # from langchain_google_genai import ChatGoogleGenerativeAI  # Commented out - using Groq instead
 from langchain_groq import ChatGroq
+from groq import APIConnectionError, BadRequestError, InternalServerError, RateLimitError
+
+# Redis is optional; without it LLM responses are not cached
+try:
+    import redis.asyncio as aioredis
+except ImportError:
+    aioredis = None
 
 # Motia event configuration
 config = {
     "type": "event",
     "name": "LearningPathGenerator",
-    "description": "Generates a learning path using LangGraph and Gemini",
+    "description": "Generates a learning path using Groq",
     "subscribes": ["learning.path.requested"],
     "emits": ["learning.path.generated", "learning.path.failed"],
     "flows": ["RoadMapAI"]
 }
 
+GROQ_MODEL = "llama-3.3-70b-versatile"  # Using Llama 3.3 70B (free tier)
+GROQ_RESPONSE_FORMAT = {"type": "json_object"}
+
+# Groq rate limit (free tier allows 30 requests/min). Every event runs in its own
+# process, so the budget is counted per minute in Redis when it is configured
+GROQ_REQUESTS_PER_MINUTE = int(os.environ.get('GROQ_REQUESTS_PER_MINUTE', '28'))
+GROQ_RATE_LIMIT_PREFIX = "roadmapai:groq:rpm:"
+# Longest a call waits for budget before going ahead and relying on Groq's 429s
+GROQ_RATE_LIMIT_MAX_WAIT_SECONDS = 120
+
+# HTTP/2 multiplexing is used for Groq calls when the h2 package is installed
+GROQ_HTTP2 = importlib.util.find_spec('h2') is not None
+
+# Retry settings for LLM calls that fail transiently or return invalid JSON
+LLM_MAX_RETRIES = 3
+LLM_MAX_BACKOFF_SECONDS = 10
+TRANSIENT_LLM_ERRORS = (RateLimitError, InternalServerError, APIConnectionError)
+JSON_RETRY_PROMPT = "Your previous reply was not valid ({error}). Return ONLY the JSON object in the requested format."
+
+# LLM response cache settings
+LLM_CACHE_PREFIX = "roadmapai:llm:"
+LLM_CACHE_TTL_SECONDS = 7 * 24 * 60 * 60
+
+# Prompt templates, filled per request with str.format
+CURRICULUM_SYSTEM_PROMPT = "You are an expert curriculum designer. Return only valid JSON."
+
+CURRICULUM_PROMPT = """You are an expert learning path designer. Design a learning path for the following:
+
+Topic: {topic}
+User Background: {background}
+Goal Level: {goal_level}
+
+First, write a brief analysis (2-3 sentences) of:
+1. What the user already knows
+2. What gaps need to be filled
+3. Recommended learning approach
+
+Then, based on that analysis, generate a structured curriculum with 4-6 modules. For each module, include:
+- Module title
+- Learning objectives (2-3 points)
+- Key concepts to cover
+- Estimated hours
+- Prerequisites (if any)
+
+Return ONLY a valid JSON object with this structure:
+{{
+  "analysis": "Your 2-3 sentence analysis",
+  "curriculum": {{
+    "title": "Learning Path Title",
+    "description": "Brief description",
+    "total_hours": 30,
+    "modules": [
+      {{
+        "order": 1,
+        "title": "Module Title",
+        "description": "What this module covers",
+        "objectives": ["objective 1", "objective 2"],
+        "key_concepts": ["concept 1", "concept 2"],
+        "estimated_hours": 5,
+        "prerequisites": []
+      }}
+    ]
+  }}
+}}
+
+Return ONLY valid JSON, no markdown formatting or extra text."""
+
+# The resources system prompt carries everything shared across a request (preferences
+# and output schema) so it forms a stable prefix for provider-side prompt caching;
+# only the module list goes in the user message
+RESOURCES_SYSTEM_PROMPT = """You are a resource curator. For each learning module you are given, recommend 3-5 high-quality resources.
+
+Preferences:
+- Include Videos: {include_videos}
+- Include Articles: {include_articles}
+- Include Docs: {include_docs}
+
+Recommend specific resources (real or realistic examples). Return ONLY valid JSON with one entry per module, using the module's order:
+{{
+  "module_resources": [
+    {{
+      "order": 1,
+      "resources": [
+        {{
+          "type": "video|article|documentation",
+          "title": "Resource Title",
+          "description": "Brief description",
+          "url": "https://example.com",
+          "duration": "30 min" or "10 min read",
+          "difficulty": "beginner|intermediate|advanced"
+        }}
+      ]
+    }}
+  ]
+}}
+
+Return ONLY valid JSON, no extra text."""
+
+RESOURCES_PROMPT = """Modules: {modules}"""
+
+
+def _validate_curriculum(result: Any) -> Dict:
+    """Check the analysis/curriculum reply has the shape the pipeline relies on"""
+    if not isinstance(result, dict) or not isinstance(result.get('curriculum'), dict):
+        raise ValueError('Expected a "curriculum" object')
+    modules = result['curriculum'].get('modules')
+    if not isinstance(modules, list):
+        raise ValueError('Expected "curriculum.modules" to be a list')
+    # Drop stray non-object entries so later stages can treat every module as a dict
+    modules = [module for module in modules if isinstance(module, dict)]
+    if not modules:
+        raise ValueError('Expected "curriculum.modules" to contain module objects')
+    result['curriculum']['modules'] = modules
+    return result
+
+
+def _validate_module_resources(result: Any) -> Dict:
+    """Check the resources reply has a list of per-module entries, each with a list of resource objects"""
+    if not isinstance(result, dict) or not isinstance(result.get('module_resources'), list):
+        raise ValueError('Expected a "module_resources" list')
+    for item in result['module_resources']:
+        if not isinstance(item, dict):
+            raise ValueError('Expected each "module_resources" entry to be an object')
+        resources = item.get('resources')
+        if not isinstance(resources, list) or not all(isinstance(resource, dict) for resource in resources):
+            raise ValueError('Expected "resources" to be a list of objects')
+    return result
+
+
+def _groq_error_body(error: Exception) -> Dict:
+    """Return the error object Groq sent with a failed request, or an empty dict"""
+    body = getattr(error, 'body', None)
+    if isinstance(body, dict) and isinstance(body.get('error'), dict):
+        body = body['error']
+    return body if isinstance(body, dict) else {}
+
+
+@dataclass(slots=True)
+class PathState:
+    """State threaded through the pipeline stages for a single request"""
+    user_id: str
+    topic: str
+    background: str
+    goal_level: str
+    preferences: Dict = field(default_factory=dict)
+    trace_id: Optional[str] = None
+    logger: Any = None
+    streams: Any = None
+    analysis: Optional[str] = None
+    curriculum_structure: Optional[Dict] = None
+    enriched_modules: Optional[List[Dict]] = None
+    final_path: Optional[Dict] = None
+    progress: int = 0
+    current_stage: str = 'analyzing'
+    error: Optional[str] = None
+
 
 class LearningPathGenerator:
-    """LangGraph-based learning path generator using Groq"""
+    """Async pipeline learning path generator using Groq"""
     
-    def __init__(self, logger=None, streams=None, emit=None, trace_id=None):
-        self.logger = logger
-        self.streams = streams
-        self.emit_fn = emit
-        self.trace_id = trace_id
-        
+    def __init__(self):
         # Initialize Groq model (using Groq to avoid quota issues)
         # GEMINI CODE (commented out):
         # api_key = os.environ.get('GEMINI_API_KEY') or os.environ.get('GOOGLE_API_KEY')
@@ -51,319 +215,454 @@ class LearningPathGenerator:
         if not groq_api_key:
             raise ValueError("GROQ_API_KEY environment variable not set")
         
+        # One pooled client for every Groq call in this event, so the connection
+        # (and TLS session) opened by the first call is reused by the next
+        self.http_client = httpx.AsyncClient(
+            http2=GROQ_HTTP2,
+            timeout=60,
+            limits=httpx.Limits(max_keepalive_connections=8, max_connections=16)
+        )
         self.llm = ChatGroq(
-            model="llama-3.3-70b-versatile",  # Using Llama 3.3 70B (free tier)
+            model=GROQ_MODEL,
             groq_api_key=groq_api_key,
             temperature=0.3,
+            http_async_client=self.http_client,
+            # Retries are owned by the rate limiter and _invoke_json; letting the SDK
+            # retry too would multiply attempts and bypass the per-minute budget
+            max_retries=0,
+            # Every prompt expects a JSON object, so let Groq guarantee one
+            model_kwargs={"response_format": GROQ_RESPONSE_FORMAT},
         )
         
-        # Build the LangGraph
-        self.graph = self._build_graph()
+        # Persistent response cache (optional)
+        redis_url = os.environ.get('REDIS_URL')
+        self.redis = aioredis.from_url(redis_url, decode_responses=True) if aioredis and redis_url else None
     
-    def _build_graph(self) -> StateGraph:
-        """Build the LangGraph workflow"""
-        workflow = StateGraph(dict)
-        
-        # Add nodes for each stage
-        workflow.add_node("analyze_background", self._analyze_background)
-        workflow.add_node("generate_curriculum", self._generate_curriculum)
-        workflow.add_node("enrich_resources", self._enrich_resources)
-        workflow.add_node("finalize_path", self._finalize_path)
-        
-        # Define the flow
-        workflow.set_entry_point("analyze_background")
-        workflow.add_edge("analyze_background", "generate_curriculum")
-        workflow.add_edge("generate_curriculum", "enrich_resources")
-        workflow.add_edge("enrich_resources", "finalize_path")
-        workflow.add_edge("finalize_path", END)
-        
-        return workflow.compile()
+    def _cache_key(self, messages: List[Dict]) -> str:
+        """Build the cache key for a prompt sent to the current model"""
+        payload = orjson.dumps(
+            {'model': GROQ_MODEL, 'response_format': GROQ_RESPONSE_FORMAT, 'messages': messages},
+            option=orjson.OPT_SORT_KEYS
+        )
+        return LLM_CACHE_PREFIX + hashlib.sha256(payload).hexdigest()
     
-    async def _stream_update(self, stage: str, message: str, progress: int, data: Optional[Dict] = None):
+    async def _cache_get(self, key: str, logger=None) -> Optional[str]:
+        """Look up a cached LLM response in Redis, when configured"""
+        if not self.redis:
+            return None
+        try:
+            return await self.redis.get(key)
+        except Exception as e:
+            if logger:
+                logger.warn("LLM cache lookup failed", {'error': str(e)})
+            return None
+    
+    async def _cache_set(self, key: str, content: str, logger=None):
+        """Store an LLM response in Redis, when configured"""
+        if self.redis:
+            try:
+                await self.redis.set(key, content, ex=LLM_CACHE_TTL_SECONDS)
+            except Exception as e:
+                if logger:
+                    logger.warn("LLM cache store failed", {'error': str(e)})
+    
+    async def _invoke_json(self, state: PathState, messages: List[Dict], validate: Callable[[Any], Dict]) -> Dict:
+        """
+        Invoke the LLM and decode its JSON reply, retrying transient API errors and replies that
+        fail to decode or that validate rejects with a ValueError
+        """
+        logger = state.logger
+        cache_key = self._cache_key(messages)
+        
+        for attempt in range(LLM_MAX_RETRIES):
+            try:
+                # Only the first attempt can hit: later ones either already missed or
+                # carry corrective retry turns, which are never cached
+                content = await self._cache_get(cache_key, logger) if attempt == 0 else None
+                from_cache = content is not None
+                if not from_cache:
+                    content = await self._call_llm(state, messages)
+                result = validate(orjson.loads(content))
+            except TRANSIENT_LLM_ERRORS as e:
+                if attempt == LLM_MAX_RETRIES - 1:
+                    raise
+                delay = min(2 ** attempt + random.random(), LLM_MAX_BACKOFF_SECONDS)
+                if logger:
+                    logger.warn("LLM call failed, retrying", {'error': str(e), 'attempt': attempt + 1, 'delay': delay})
+                await asyncio.sleep(delay)
+                continue
+            except BadRequestError as e:
+                # In JSON mode Groq rejects output that is not valid JSON with a 400
+                # instead of returning it, so treat that like a reply that failed to decode
+                body = _groq_error_body(e)
+                if body.get('code') != 'json_validate_failed':
+                    raise
+                if attempt == LLM_MAX_RETRIES - 1:
+                    raise ValueError(f"LLM output failed JSON validation: {e}") from e
+                content, error = body.get('failed_generation') or '', e
+            except ValueError as e:
+                if attempt == LLM_MAX_RETRIES - 1:
+                    raise
+                error = e
+            else:
+                # Only cache fresh replies that decoded and validated, keyed on the original
+                # prompt so repeat requests hit even when this one needed a corrective retry
+                if not from_cache:
+                    await self._cache_set(cache_key, content, logger)
+                return result
+            
+            if logger:
+                logger.warn("LLM returned invalid output, retrying", {'error': str(error), 'attempt': attempt + 1})
+            retry_messages = [{"role": "assistant", "content": content}] if content else []
+            retry_messages.append({"role": "user", "content": JSON_RETRY_PROMPT.format(error=error)})
+            messages = messages + retry_messages
+    
+    async def _call_llm(self, state: PathState, messages: List[Dict]) -> str:
+        """Send messages to Groq once the rate limit allows and return the reply content"""
+        await self._acquire_rate_limit(state.logger)
+        # Groq's JSON mode does not support streaming, so the reply is fetched whole;
+        # this also makes json_validate_failed arrive as a BadRequestError
+        reply = await self.llm.ainvoke(messages)
+        return reply.content
+    
+    async def _acquire_rate_limit(self, logger=None):
+        """
+        Wait for a slot in the per-minute Groq budget shared through Redis.
+        Windows are fixed calendar minutes, so up to twice the budget can land in a
+        burst straddling a minute boundary; Groq's own 429s cover that edge.
+        """
+        if not self.redis:
+            return
+        
+        deadline = time.monotonic() + GROQ_RATE_LIMIT_MAX_WAIT_SECONDS
+        while True:
+            window = int(time.time() // 60)
+            key = f"{GROQ_RATE_LIMIT_PREFIX}{window}"
+            try:
+                async with self.redis.pipeline(transaction=True) as pipe:
+                    count, _ = await pipe.incr(key).expire(key, 120).execute()
+            except Exception as e:
+                # Losing the limiter should not fail the request; Groq's 429s are still retried
+                if logger:
+                    logger.warn("Groq rate limit check failed", {'error': str(e)})
+                return
+            
+            if count <= GROQ_REQUESTS_PER_MINUTE:
+                return
+            
+            delay = (window + 1) * 60 - time.time() + random.random()
+            if time.monotonic() + delay > deadline:
+                # Waiting longer risks outliving the running-request claim, so go
+                # ahead and let _invoke_json back off on a 429 instead
+                if logger:
+                    logger.warn("Groq rate limit wait exceeded, calling anyway", {'count': count})
+                return
+            await asyncio.sleep(delay)
+    
+    async def _stream_update(self, state: PathState, stage: str, message: str, progress: int, data: Optional[Dict] = None):
         """Helper to stream progress updates"""
-        if self.streams and self.trace_id:
+        streams, trace_id, logger = state.streams, state.trace_id, state.logger
+        if streams and trace_id:
             update_data = {
                 'stage': stage,
                 'message': message,
                 'progress': progress,
-                'timestamp': int(datetime.now().timestamp() * 1000)
+                'timestamp': time.time_ns() // 1_000_000
             }
             if data:
                 update_data['data'] = data
             
-            await self.streams.learningPathCreation.set(self.trace_id, 'learningPath', update_data)
+            await streams.learningPathCreation.set(trace_id, 'learningPath', update_data)
         
-        if self.logger:
-            self.logger.info(f"📊 {stage}: {message}", {'progress': progress})
+        if logger:
+            logger.info(f"📊 {stage}: {message}", {'progress': progress})
     
-    async def _analyze_background(self, state: Dict) -> Dict:
-        """Node 1: Analyze user background and learning goals"""
+    async def _analyze_and_generate(self, state: PathState) -> None:
+        """Stage 1: Analyze user background and generate the curriculum in a single LLM call"""
+        logger = state.logger
         await self._stream_update(
+            state,
             'analyzing',
-            f'Analyzing your background for {state["topic"]}...',
+            f'Analyzing your background for {state.topic}...',
             15
         )
         
-        prompt = f"""You are an expert learning path designer. Analyze the following:
-
-                        Topic: {state['topic']}
-                        User Background: {state['background']}
-                        Goal Level: {state['goal_level']}
-
-                        Provide a brief analysis (2-3 sentences) of:
-                        1. What the user already knows
-                        2. What gaps need to be filled
-                        3. Recommended learning approach
-
-                        Return ONLY the analysis text, no extra formatting.
-                """
-
-        response = await self.llm.ainvoke([
-            {"role": "system", "content": "You are an expert educational curriculum designer."},
-            {"role": "user", "content": prompt}
-        ])
-        
-        analysis = response.content.strip()
+        prompt = CURRICULUM_PROMPT.format(topic=state.topic, background=state.background, goal_level=state.goal_level)
         
-        if self.logger:
-            self.logger.info("✅ Background analysis completed", {'topic': state['topic']})
-        
-        state['analysis'] = analysis
-        state['progress'] = 20
-        state['current_stage'] = 'analyzing'
-        
-        return state
-    
-    async def _generate_curriculum(self, state: Dict) -> Dict:
-        """Node 2: Generate curriculum structure with modules"""
-        await self._stream_update(
-            'generating',
-            f'Creating curriculum structure for {state["topic"]}...',
-            40
-        )
-        
-        prompt = f"""Create a detailed learning curriculum for the following:
-
-Topic: {state['topic']}
-User Background: {state['background']}
-Goal Level: {state['goal_level']}
-Analysis: {state['analysis']}
-
-Generate a structured curriculum with 4-6 modules. For each module, include:
-- Module title
-- Learning objectives (2-3 points)
-- Key concepts to cover
-- Estimated hours
-- Prerequisites (if any)
-
-Return ONLY a valid JSON object with this structure:
-{{
-  "title": "Learning Path Title",
-  "description": "Brief description",
-  "total_hours": 30,
-  "modules": [
-    {{
-      "order": 1,
-      "title": "Module Title",
-      "description": "What this module covers",
-      "objectives": ["objective 1", "objective 2"],
-      "key_concepts": ["concept 1", "concept 2"],
-      "estimated_hours": 5,
-      "prerequisites": []
-    }}
-  ]
-}}
-
-Return ONLY valid JSON, no markdown formatting or extra text."""
-
-        response = await self.llm.ainvoke([
-            {"role": "system", "content": "You are an expert curriculum designer. Return only valid JSON."},
-            {"role": "user", "content": prompt}
-        ])
-        
-        # Parse JSON response
         try:
-            # Remove markdown code blocks if present
-            content = response.content.strip()
-            if content.startswith('```'):
-                content = content.split('```')[1]
-                if content.startswith('json'):
-                    content = content[4:]
-            content = content.strip()
-            
-            curriculum = json.loads(content)
-        except json.JSONDecodeError as e:
-            if self.logger:
-                self.logger.error("Failed to parse curriculum JSON", {'error': str(e)})
+            result = await self._invoke_json(
+                state,
+                [{"role": "system", "content": CURRICULUM_SYSTEM_PROMPT}, {"role": "user", "content": prompt}],
+                _validate_curriculum
+            )
+            analysis = str(result.get('analysis', '')).strip()
+            curriculum = result['curriculum']
+        except (orjson.JSONDecodeError, ValueError) as e:
+            if logger:
+                logger.error("Failed to parse curriculum JSON", {'error': str(e)})
             # Fallback to basic structure
+            analysis = ''
             curriculum = {
-                "title": f"Learning Path: {state['topic']}",
-                "description": state['analysis'],
+                "title": f"Learning Path: {state.topic}",
+                "description": f"Learning path for {state.topic}",
                 "total_hours": 30,
                 "modules": []
             }
         
-        if self.logger:
-            self.logger.info("✅ Curriculum structure generated", {
+        await self._stream_update(
+            state,
+            'generating',
+            f'Created curriculum structure for {state.topic}',
+            60
+        )
+        
+        if logger:
+            logger.info("✅ Background analysis and curriculum structure generated", {
                 'modules': len(curriculum.get('modules', [])),
-                'topic': state['topic']
+                'topic': state.topic
             })
         
-        state['curriculum_structure'] = curriculum
-        state['progress'] = 60
-        state['current_stage'] = 'generating'
-        
-        return state
+        state.analysis = analysis
+        state.curriculum_structure = curriculum
+        state.progress = 60
+        state.current_stage = 'generating'
     
-    async def _enrich_resources(self, state: Dict) -> Dict:
-        """Node 3: Enrich modules with recommended resources"""
+    async def _enrich_resources(self, state: PathState) -> None:
+        """Stage 2: Enrich modules with recommended resources"""
+        logger = state.logger
         await self._stream_update(
+            state,
             'enriching',
             'Finding the best learning resources...',
             75
         )
         
-        curriculum = state['curriculum_structure']
-        preferences = state.get('preferences', {})
-        
-        enriched_modules = []
-        
-        for idx, module in enumerate(curriculum.get('modules', [])):
-            # Generate resource recommendations for each module
-            prompt = f"""For this learning module, recommend 3-5 high-quality resources:
-
-Module: {module['title']}
-Description: {module.get('description', '')}
-Key Concepts: {', '.join(module.get('key_concepts', []))}
-
-Preferences:
-- Include Videos: {preferences.get('includeVideos', True)}
-- Include Articles: {preferences.get('includeArticles', True)}
-- Include Docs: {preferences.get('includeDocs', True)}
-
-Recommend specific resources (real or realistic examples). Return ONLY valid JSON:
-{{
-  "resources": [
-    {{
-      "type": "video|article|documentation",
-      "title": "Resource Title",
-      "description": "Brief description",
-      "url": "https://example.com",
-      "duration": "30 min" or "10 min read",
-      "difficulty": "beginner|intermediate|advanced"
-    }}
-  ]
-}}
-
-Return ONLY valid JSON, no extra text."""
-
-            response = await self.llm.ainvoke([
-                {"role": "system", "content": "You are a resource curator. Return only valid JSON."},
-                {"role": "user", "content": prompt}
-            ])
+        curriculum = state.curriculum_structure
+        preferences = state.preferences
+        
+        modules = curriculum.get('modules', []) or []
+        n = len(modules)
+        
+        # Resources are collected in a parallel list so the module dicts stay
+        # read-only until the reply has been fully matched up. Modules are numbered
+        # by position in the prompt, since the LLM's own orders may repeat or be missing.
+        orders = list(range(1, n + 1))
+        resources_out: List[Optional[List[Dict]]] = [None] * n
+        
+        if n:
+            # Ask for every module's resources in one call so the shared
+            # preferences and output schema are only sent once
+            module_summaries = orjson.dumps([
+                {
+                    'order': order,
+                    'title': module.get('title', ''),
+                    'description': module.get('description', ''),
+                    'key_concepts': module.get('key_concepts', [])
+                }
+                for order, module in zip(orders, modules)
+            ]).decode()
             
+            system_message = {"role": "system", "content": RESOURCES_SYSTEM_PROMPT.format(
+                include_videos=bool(preferences.get('includeVideos', True)),
+                include_articles=bool(preferences.get('includeArticles', True)),
+                include_docs=bool(preferences.get('includeDocs', True))
+            )}
+            prompt = RESOURCES_PROMPT.format(modules=module_summaries)
+
             try:
-                content = response.content.strip()
-                if content.startswith('```'):
-                    content = content.split('```')[1]
-                    if content.startswith('json'):
-                        content = content[4:]
-                content = content.strip()
-                
-                resources_data = json.loads(content)
-                module['resources'] = resources_data.get('resources', [])
-            except json.JSONDecodeError:
-                module['resources'] = []
-            
-            enriched_modules.append(module)
-            
-            # Update progress
-            progress = 75 + int((idx + 1) / len(curriculum.get('modules', [])) * 15)
-            await self._stream_update(
-                'enriching',
-                f'Enriched module {idx + 1}/{len(curriculum.get("modules", []))}',
-                progress
-            )
+                resources_data = await self._invoke_json(
+                    state,
+                    [system_message, {"role": "user", "content": prompt}],
+                    _validate_module_resources
+                )
+                index_by_order = {str(order): idx for idx, order in enumerate(orders)}
+                for item in resources_data['module_resources']:
+                    idx = index_by_order.get(str(item.get('order')))
+                    if idx is not None:
+                        resources_out[idx] = item['resources']
+            except (ValueError, BadRequestError, *TRANSIENT_LLM_ERRORS) as e:
+                # Ship the curriculum without resources when the LLM keeps failing;
+                # anything else is a bug and should fail the request
+                if logger:
+                    logger.error("Failed to enrich modules", {'error': str(e)})
+        
+        for module, resources in zip(modules, resources_out):
+            module['resources'] = resources or []
+        
+        enriched_modules = modules
         
-        if self.logger:
-            self.logger.info("✅ Resources enriched", {
-                'modules': len(enriched_modules),
-                'topic': state['topic']
-            })
+        await self._stream_update(
+            state,
+            'enriching',
+            f'Enriched {n} modules',
+            90
+        )
         
-        state['enriched_modules'] = enriched_modules
-        state['progress'] = 90
-        state['current_stage'] = 'enriching'
+        if logger:
+            logger.info("✅ Resources enriched", {
+                'modules': n,
+                'topic': state.topic
+            })
         
-        return state
+        state.enriched_modules = enriched_modules
+        state.progress = 90
+        state.current_stage = 'enriching'
     
-    async def _finalize_path(self, state: Dict) -> Dict:
-        """Node 4: Finalize the learning path"""
+    async def _finalize_path(self, state: PathState) -> None:
+        """Stage 3: Finalize the learning path"""
+        logger = state.logger
         await self._stream_update(
+            state,
             'completed',
-            f'Your {state["topic"]} learning path is ready! 🎉',
+            f'Your {state.topic} learning path is ready! 🎉',
             100
         )
         
-        curriculum = state['curriculum_structure']
-        curriculum['modules'] = state['enriched_modules']
+        curriculum = state.curriculum_structure
+        curriculum['modules'] = state.enriched_modules
         
         final_path = {
-            'userId': state['user_id'],
-            'topic': state['topic'],
-            'background': state['background'],  
-            'goalLevel': state['goal_level'],
-            'preferences': state.get('preferences', {}),
-            'analysis': state['analysis'],
+            'userId': state.user_id,
+            'topic': state.topic,
+            'background': state.background,  
+            'goalLevel': state.goal_level,
+            'preferences': state.preferences,
+            'analysis': state.analysis,
             'curriculum': curriculum,
             'createdAt': datetime.now().isoformat(),
-            'traceId': state['trace_id']
+            'traceId': state.trace_id
         }
         
-        if self.logger:
-            self.logger.info("🎉 Learning path finalized", {
-                'topic': state['topic'],
+        if logger:
+            logger.info("🎉 Learning path finalized", {
+                'topic': state.topic,
                 'modules': len(curriculum.get('modules', []))
             })
         
-        state['final_path'] = final_path
-        state['progress'] = 100
-        state['current_stage'] = 'completed'
-        
-        return state
+        state.final_path = final_path
+        state.progress = 100
+        state.current_stage = 'completed'
     
-    async def generate(self, req: Dict) -> Dict:
-        """Run the LangGraph to generate a learning path"""
-        # Initialize state
-        initial_state = {
-            'user_id': req.get('userId'),
-            'topic': req.get('topic'),
-            'background': req.get('background'),
-            'goal_level': req.get('goalLevel', 'intermediate'),
-            'preferences': req.get('preferences', {}),
-            'trace_id': req.get('traceId'),
-            'analysis': None,
-            'curriculum_structure': None,
-            'enriched_modules': None,
-            'final_path': None,
-            'progress': 0,
-            'current_stage': 'analyzing',
-            'error': None
-        }
+    async def generate(self, req: Dict, logger=None, streams=None, trace_id=None) -> Dict:
+        """Run the pipeline stages in order to generate a learning path"""
+        # Initialize state; per-request context lives here rather than on the generator
+        state = PathState(
+            user_id=req.get('userId'),
+            topic=req.get('topic'),
+            background=req.get('background'),
+            goal_level=req.get('goalLevel', 'intermediate'),
+            preferences=req.get('preferences') or {},
+            trace_id=trace_id or req.get('traceId'),
+            logger=logger,
+            streams=streams
+        )
         
-        # Run the graph
-        final_state = await self.graph.ainvoke(initial_state)
+        # The stages form a straight line and each writes its own fields,
+        # so they update the one state object in place
+        await self._analyze_and_generate(state)
+        await self._enrich_resources(state)
+        await self._finalize_path(state)
         
-        return final_state['final_path']
+        return state.final_path
+    
+    async def aclose(self):
+        """Release the network clients held by this generator"""
+        await self.http_client.aclose()
+        if self.redis:
+            await self.redis.aclose()
+
+
+# Input limits, checked before any LLM work starts
+MAX_TOPIC_CHARS = 200
+MAX_BACKGROUND_CHARS = 4000
+
+# Redis keys recording which requests are running or completed, used to drop
+# duplicate deliveries of the same event across runner processes. Both states
+# expire, so the keys stay bounded without any pruning.
+REQUEST_KEY_PREFIX = "roadmapai:request:"
+# Longer than the slowest possible run (two calls, each with three attempts of up to
+# 120s rate-limit wait, 60s HTTP timeout and 10s backoff); an older claim is
+# assumed lost, so a redelivery may start over
+REQUEST_RUNNING_TTL_SECONDS = 20 * 60
+REQUEST_COMPLETED_TTL_SECONDS = 24 * 60 * 60
+
+
+async def _claim_request(redis, logger, trace_id: Optional[str]) -> Optional[str]:
+    """
+    Atomically mark trace_id as running, or return its current status if
+    another delivery already claimed it. Without Redis nothing is deduplicated.
+    """
+    if not redis or not trace_id:
+        return None
+    
+    key = REQUEST_KEY_PREFIX + trace_id
+    try:
+        if await redis.set(key, 'running', nx=True, ex=REQUEST_RUNNING_TTL_SECONDS):
+            return None
+        # The claim may expire between the two calls; treat it as still running
+        return await redis.get(key) or 'running'
+    except Exception as e:
+        # Deduplication is best effort; never fail the request over it
+        if logger:
+            logger.warn('Request deduplication unavailable', {'error': str(e), 'traceId': trace_id})
+        return None
+
+
+async def _release_request(redis, logger, trace_id: Optional[str], completed: bool):
+    """Record a completed request, or forget a failed one so a redelivery can retry it"""
+    if not redis or not trace_id:
+        return
+    
+    key = REQUEST_KEY_PREFIX + trace_id
+    try:
+        if completed:
+            await redis.set(key, 'completed', ex=REQUEST_COMPLETED_TTL_SECONDS)
+        else:
+            await redis.delete(key)
+    except Exception as e:
+        if logger:
+            logger.warn('Failed to update request state', {'error': str(e), 'traceId': trace_id})
+
+
+async def _emit_failure(emit, streams, logger, user_id, topic, trace_id, error: str):
+    """Log, stream and emit a failed learning path request"""
+    if logger:
+        logger.error('❌ Learning path generation failed', {
+            'userId': user_id,
+            'topic': topic,
+            'error': error,
+            'traceId': trace_id
+        })
+    
+    # Stream error
+    if streams and trace_id:
+        await streams.learningPathCreation.set(trace_id, 'learningPath', {
+            'stage': 'error',
+            'message': f'Failed to generate learning path: {error}',
+            'progress': 0,
+            'timestamp': time.time_ns() // 1_000_000
+        })
+    
+    # Emit failure event
+    if emit:
+        await emit({
+            'topic': 'learning.path.failed',
+            'data': {
+                'userId': user_id,
+                'topic': topic,
+                'error': error,
+                'traceId': trace_id
+            }
+        })
 
 
 async def handler(req, ctx=None):
     """
-    Main handler that processes learning path requests using LangGraph + Groq
+    Main handler that processes learning path requests using Groq
     
     Flow:
     1. Receive event from TypeScript API
-    2. Initialize LangGraph generator
+    2. Initialize the learning path generator
     3. Stream progress updates during generation
     4. Emit completion event
     """
@@ -376,30 +675,58 @@ async def handler(req, ctx=None):
     
     # Extract data from event
     user_id = req.get('userId')
-    topic = req.get('topic')
-    background = req.get('background')
+    topic = (req.get('topic') or '').strip()
+    background = (req.get('background') or '').strip()
     goal_level = req.get('goalLevel', 'intermediate')
     preferences = req.get('preferences', {})
     
-    if logger:
-        logger.info('🤖 LangGraph Agent activated', {
-            'userId': user_id,
-            'topic': topic,
-            'goalLevel': goal_level,
-            'traceId': trace_id
-        })
+    # Reject malformed requests before spending any LLM calls on them
+    missing = [name for name, value in (('userId', user_id), ('topic', topic), ('background', background)) if not value]
+    if missing:
+        await _emit_failure(emit, streams, logger, user_id, topic, trace_id,
+                            f'Missing required fields: {", ".join(missing)}')
+        return
+    
+    topic = topic[:MAX_TOPIC_CHARS]
+    background = background[:MAX_BACKGROUND_CHARS]
+    req = {**req, 'topic': topic, 'background': background}
     
+    generator = None
+    claimed = False
     try:
-        # Initialize LangGraph generator
-        generator = LearningPathGenerator(
-            logger=logger,
-            streams=streams,
-            emit=emit,
-            trace_id=trace_id
-        )
+        # Motia runs each invocation of a Python step in its own process, so
+        # nothing built here outlives this event
+        generator = LearningPathGenerator()
+        
+        previous = await _claim_request(generator.redis, logger, trace_id)
+        if previous:
+            if logger:
+                logger.warn('⚠️ Duplicate learning path request ignored', {
+                    'traceId': trace_id,
+                    'status': previous
+                })
+            # A running original streams its own final update; a completed one already
+            # did, but the client may have reset the stream before redelivering
+            if previous == 'completed' and streams:
+                await streams.learningPathCreation.set(trace_id, 'learningPath', {
+                    'stage': 'completed',
+                    'message': f'Your {topic} learning path is ready! 🎉',
+                    'progress': 100,
+                    'timestamp': time.time_ns() // 1_000_000
+                })
+            return
+        claimed = True
+        
+        if logger:
+            logger.info('🤖 Learning path agent activated', {
+                'userId': user_id,
+                'topic': topic,
+                'goalLevel': goal_level,
+                'traceId': trace_id
+            })
         
         # Generate learning path
-        learning_path = await generator.generate(req)
+        learning_path = await generator.generate(req, logger=logger, streams=streams, trace_id=trace_id)
         
         # Emit completion event
         if emit:
@@ -410,9 +737,10 @@ async def handler(req, ctx=None):
                     'topic': topic,
                     'learningPath': learning_path,
                     'traceId': trace_id,
-                    'completedAt': int(datetime.now().timestamp() * 1000)
+                    'completedAt': time.time_ns() // 1_000_000
                 }
             })
+        await _release_request(generator.redis, logger, trace_id, completed=True)
         
         if logger:
             logger.info('🎉 Learning path generation completed successfully', {
@@ -421,31 +749,10 @@ async def handler(req, ctx=None):
             })
     
     except Exception as error:
-        if logger:
-            logger.error('❌ Learning path generation failed', {
-                'userId': user_id,
-                'topic': topic,
-                'error': str(error),
-                'traceId': trace_id
-            })
-        
-        # Stream error
-        if streams and trace_id:
-            await streams.learningPathCreation.set(trace_id, 'learningPath', {
-                'stage': 'error',
-                'message': f'Failed to generate learning path: {str(error)}',
-                'progress': 0,
-                'timestamp': int(datetime.now().timestamp() * 1000)
-            })
-        
-        # Emit failure event
-        if emit:
-            await emit({
-                'topic': 'learning.path.failed',
-                'data': {
-                    'userId': user_id,
-                    'topic': topic,
-                    'error': str(error),
-                    'traceId': trace_id
-                }
-            })
\ No newline at end of file
+        if claimed:
+            await _release_request(generator.redis, logger, trace_id, completed=False)
+        await _emit_failure(emit, streams, logger, user_id, topic, trace_id, str(error))
+    
+    finally:
+        if generator:
+            await generator.aclose()
\ No newline at end of file
@@ -68,7 +68,7 @@ const createLearningPathHandler: Handlers['CreateLearningPath'] = async (req: an
       }
     }
 
-    // Emit event to trigger Python LangGraph agent
+    // Emit event to trigger the Python learning path agent
     if (emit) {
       await emit({
         topic: 'learning.path.requested',
@@ -84,7 +84,7 @@ const createLearningPathHandler: Handlers['CreateLearningPath'] = async (req: an
       } as any);
 
       if (logger) {
-        logger.info('✅ Event emitted to LangGraph agent', {
+        logger.info('✅ Event emitted to learning path agent', {
           userId,
           topic: validatedData.topic,
           traceId